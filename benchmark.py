@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+
+##########################
+#   Administrative Data  #
+##########################
+__title__       = "GovDataBenchmark"
+__description__ = '''This module runs GovDataCollector end to end against a local stand-in for the CKAN catalog and its resource hosts.'''
+__example__     = "./benchmark.py -n 2000 -s 512 -H 20 -l 50 -e 0.01"
+__author__      = "Robert G. Jamison"
+__copyright__   = "Copyright 2021"
+
+__license__     = '''"MIT License" - Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the “Software”), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions: The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.  THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.'''
+__version__     = "1.0.1"
+__status__      = "Production"
+
+##########################
+#        LIBRARIES       #
+##########################
+
+import os
+import sys
+import json
+import time
+import zlib
+import random
+import getopt
+import shutil
+import resource
+import tempfile
+import threading
+import subprocess
+import http.server
+from urllib.parse import urlparse, parse_qs
+
+##########################
+#        FUNCTIONS       #
+##########################
+
+# One fixed-width row of a stand-in salary dataset, so a file's size is known before it is sent.
+def dataset_row(i, row):
+    return "%08d,Employee %08d,Job Title %04d,Department %03d,%06d\n" % (i, row, row % 5000, row % 200, row % 250000)
+
+DATASET_HEADER = "id,employee_name,job_title,department,salary\n"
+ROW_SIZE = len(dataset_row(0, 0))
+
+##########################
+#         CLASSES        #
+##########################
+
+# Serves package_search pages and the files they point at, with the latency and errors we ask for.
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    settings = {}
+
+    def log_message(self, format, *args):
+        # keep the benchmark output readable
+        return
+
+    def do_GET(self):
+        settings = self.settings
+        time.sleep(settings['latency'])
+        url = urlparse(self.path)
+        if url.path.endswith("/action/package_search"):
+            self.package_search(parse_qs(url.query))
+        elif url.path.startswith("/files/"):
+            # some requests fail, the same way a busy publisher would
+            if settings['random'].random() < settings['error_rate']:
+                self.send_body(503, b"Service Unavailable", "text/plain")
+            else:
+                self.dataset(int(url.path.split("/")[-1].split(".")[0]))
+        else:
+            self.send_body(404, b"Not Found", "text/plain")
+        return
+
+    def package_search(self, query):
+        # Like CKAN, cap the rows per page whatever the client asks for
+        settings = self.settings
+        start = int(query.get('start', ["0"])[0])
+        rows = min(int(query.get('rows', ["10"])[0]), settings['page_cap'])
+        results = []
+        for i in range(start, min(start + rows, settings['packages'])):
+            # every "duplicate_every"th package shares its file with the package before it
+            file_id = i
+            if settings['duplicate_every'] and i % settings['duplicate_every'] == 0 and i > 0:
+                file_id = i - 1
+            host = settings['hosts'][file_id % len(settings['hosts'])]
+            results.append({
+                'id': "package-" + str(i),
+                'maintainer': "Maintainer " + str(i),
+                'maintainer_email': "maintainer" + str(i) + "@example.gov",
+                'organization': {'name': "organization-" + str(i % 300)},
+                'extras': [
+                    {'key': "publisher", 'value': "Publisher " + str(i % 300)},
+                    {'key': "issued", 'value': "2021-01-01"},
+                    {'key': "modified", 'value': "2021-06-01"}
+                    ],
+                'resources': [
+                    {'id': "json-" + str(i), 'format': "JSON", 'mimetype': "application/json", 'url': host + "/files/" + str(file_id) + ".json"},
+                    {'id': "csv-" + str(i), 'format': "CSV", 'mimetype': "text/csv", 'url': host + "/files/" + str(file_id) + ".csv"}
+                    ]
+                })
+        body = json.dumps({'success': True, 'result': {'count': settings['packages'], 'results': results}})
+        self.send_body(200, body.encode(), "application/json")
+        return
+
+    def dataset(self, i):
+        # Stream a generated CSV, honouring conditional, range and gzip requests
+        rows = self.settings['rows']
+        size = len(DATASET_HEADER) + rows * ROW_SIZE
+        etag = '"' + str(i) + "-" + str(size) + '"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        start = 0
+        if self.headers.get('Range') and self.headers.get('If-Range', etag) == etag:
+            start = int(self.headers['Range'].split("=")[1].split("-")[0])
+        gzipped = self.settings['gzip'] and start == 0 and "gzip" in self.headers.get('Accept-Encoding', "")
+        if start > 0:
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes " + str(start) + "-" + str(size - 1) + "/" + str(size))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "text/csv")
+        self.send_header("ETag", etag)
+        self.send_header("Accept-Ranges", "bytes")
+        if gzipped:
+            # the compressed size is not known up front, so send it in chunks
+            self.send_header("Content-Encoding", "gzip")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+            for block in self.dataset_blocks(i, rows, 0):
+                self.send_chunk(compressor.compress(block))
+            self.send_chunk(compressor.flush())
+            self.wfile.write(b"0\r\n\r\n")
+        else:
+            self.send_header("Content-Length", str(size - start))
+            self.end_headers()
+            for block in self.dataset_blocks(i, rows, start):
+                self.wfile.write(block)
+        return
+
+    def dataset_blocks(self, i, rows, start):
+        # The file a block of rows at a time, skipping the first "start" bytes
+        offset = 0
+        block = DATASET_HEADER
+        for row in range(rows):
+            block += dataset_row(i, row)
+            if len(block) >= 65536 or row == rows - 1:
+                data = block.encode()
+                if offset + len(data) > start:
+                    yield data[max(start - offset, 0):]
+                offset += len(data)
+                block = ""
+        if rows == 0:
+            yield DATASET_HEADER.encode()[start:]
+        return
+
+    def send_chunk(self, data):
+        if data:
+            self.wfile.write(("%x\r\n" % len(data)).encode() + data + b"\r\n")
+        return
+
+    def send_body(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return
+
+class GovDataBenchmark:
+
+    def __init__(self, packages, file_kb, hosts, latency_ms, error_rate, page_cap, duplicate_every, gzip):
+        self.width = shutil.get_terminal_size()[0]
+        self.settings = {
+            'packages': packages,
+            'rows': max(int(file_kb * 1024 / ROW_SIZE), 0),
+            'latency': latency_ms / 1000.0,
+            'error_rate': error_rate,
+            'page_cap': page_cap,
+            'duplicate_every': duplicate_every,
+            'gzip': gzip,
+            'random': random.Random(0),
+            'hosts': []
+            }
+        StandInHandler.settings = self.settings
+        # one server for the catalog and one per resource host, each on its own port
+        self.servers = []
+        self.catalog = self.start_server()
+        for host in range(hosts):
+            self.settings['hosts'].append(self.start_server())
+        self.catalog_url = self.catalog + "/api/3"
+        return
+
+    def start_server(self):
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.servers.append(server)
+        return "http://127.0.0.1:" + str(server.server_address[1])
+
+    def msg(self, message):
+        print()
+        print("=" * self.width)
+        print(message)
+        print("=" * self.width)
+        print()
+        return
+
+    def run(self, path, arguments, label):
+        # Run collector.py in its own process so its time and memory are measured on their own
+        self.msg("Running " + label)
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "collector.py"),
+            "-u", self.catalog_url, "-p", path, "-r", "0", "-d"] + arguments
+        started = time.perf_counter()
+        process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        stderr = process.stderr.read()
+        pid, status, usage = os.wait4(process.pid, 0)
+        seconds = time.perf_counter() - started
+        if status != 0:
+            print(stderr.decode(errors='replace'))
+            print("ERROR: collector.py exited with status " + str(status))
+            sys.exit(1)
+        with open(path + "Report.json") as file:
+            report = json.load(file)
+        downloaded = report['requests'].get('download', {}).get('bytes', 0)
+        result = {
+            'seconds': seconds,
+            # ru_maxrss is in kilobytes on Linux
+            'peak_memory_mb': usage.ru_maxrss / 1024.0,
+            'packages_per_second': self.settings['packages'] / seconds,
+            'download_mb_per_second': report.get('download_bytes_per_second', 0) / (1024 * 1024),
+            'downloaded_mb': downloaded / (1024 * 1024),
+            'phases': dict((name, phase['seconds']) for name, phase in report['phases'].items()),
+            'counters': report['counters']
+            }
+        print("+ " + label + " took " + "%.2f" % seconds + "s, peak memory " + "%.1f" % result['peak_memory_mb'] + " MB")
+        for name, phase_seconds in result['phases'].items():
+            print("  - " + name + ": " + "%.2f" % phase_seconds + "s")
+        print("  - downloads: " + "%.2f" % result['downloaded_mb'] + " MB at " + "%.2f" % result['download_mb_per_second'] + " MB/s")
+        return result
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        return
+
+##########################
+#          MAIN          #
+##########################
+
+def main(argv):
+    packages = 500
+    file_kb = 256
+    hosts = 10
+    latency_ms = 20
+    error_rate = 0.0
+    page_cap = 1000
+    duplicate_every = 0
+    gzip = False
+    runs = 2
+    output = ""
+    baseline = ""
+    arguments = []
+
+    help = "Usage:  " + sys.argv[0] + " -n <packages> -s <file_kb> -H <hosts> -l <latency_ms> -e <error_rate>" + """
+    -c <page_cap>         most rows the catalog returns per page (CKAN's cap)
+    -D <n>                every nth package shares the previous package's file
+    -g                    let the hosts gzip responses when asked
+    -R <runs>             first run starts empty, the rest re-sync the same directory
+    -o <results.json>     save the results
+    -b <baseline.json>    compare against results saved earlier
+    -a "<arguments>"      extra arguments for collector.py, e.g. "-w 16 -c 4"
+    """
+    try:
+        opts, args = getopt.getopt(argv,"hgn:s:H:l:e:c:D:R:o:b:a:")
+    except getopt.GetoptError:
+        print(help)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print(help)
+            sys.exit()
+        elif opt == '-g':
+            gzip = True
+        elif opt == '-n':
+            packages = int(arg)
+        elif opt == '-s':
+            file_kb = float(arg)
+        elif opt == '-H':
+            hosts = int(arg)
+        elif opt == '-l':
+            latency_ms = float(arg)
+        elif opt == '-e':
+            error_rate = float(arg)
+        elif opt == '-c':
+            page_cap = int(arg)
+        elif opt == '-D':
+            duplicate_every = int(arg)
+        elif opt == '-R':
+            runs = int(arg)
+        elif opt == '-o':
+            output = arg
+        elif opt == '-b':
+            baseline = arg
+        elif opt == '-a':
+            arguments = arg.split()
+
+    benchmark = GovDataBenchmark(packages, file_kb, hosts, latency_ms, error_rate, page_cap, duplicate_every, gzip)
+    path = tempfile.mkdtemp(prefix="govdata-benchmark-") + "/"
+    results = {
+        'settings': {
+            'packages': packages,
+            'file_kb': file_kb,
+            'hosts': hosts,
+            'latency_ms': latency_ms,
+            'error_rate': error_rate,
+            'page_cap': page_cap,
+            'duplicate_every': duplicate_every,
+            'gzip': gzip,
+            'arguments': arguments
+            },
+        'runs': []
+        }
+    try:
+        for run in range(runs):
+            if run == 0:
+                label = "cold run (empty directory)"
+            else:
+                label = "warm run " + str(run) + " (re-sync)"
+            results['runs'].append(dict(benchmark.run(path, arguments, label), label=label))
+    finally:
+        benchmark.stop()
+        shutil.rmtree(path, ignore_errors=True)
+
+    if baseline:
+        # Show how each run compares with the same run in the baseline
+        benchmark.msg("Compared with " + baseline)
+        with open(baseline) as file:
+            before = json.load(file)
+        for old, new in zip(before['runs'], results['runs']):
+            change = (new['seconds'] - old['seconds']) / old['seconds'] * 100
+            print("+ " + new['label'] + ": " + "%.2f" % old['seconds'] + "s -> " + "%.2f" % new['seconds'] + "s (" + "%+.1f" % change + "%)")
+            print("  - peak memory: " + "%.1f" % old['peak_memory_mb'] + " MB -> " + "%.1f" % new['peak_memory_mb'] + " MB")
+    if output:
+        with open(output, 'w') as file:
+            json.dump(results, file, indent=2)
+        print("Results saved at " + output)
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
@@ -18,53 +18,771 @@ __status__      = "Production"
 ##########################
 
 import requests
+import urllib3
 import json
 import pandas
-import xlsxwriter
 import os
 import sys
 import getopt
+import csv
+import gzip
+import zlib
+import time
+import codecs
+import cProfile
+import contextlib
+import shutil
+import sqlite3
+import hashlib
+import threading
+import collections
+import concurrent.futures
 from os.path import exists
+from urllib.parse import urlparse
+
+# zstd at-rest compression is optional
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# bytes read from the network and written to disk at a time
+CHUNK_SIZE = 1024 * 1024
+
+# bytes read from the start of a file to work out its schema
+SAMPLE_SIZE = 64 * 1024
+
+# file name endings for each way of storing datasets under data/
+COMPRESSION_SUFFIX = {"": "", "gzip": ".gz", "zstd": ".zst"}
+
+# upper bounds, in seconds, of the request latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# download statuses that do not need another attempt
+FINISHED = ("GOOD", "UNCHANGED", "SKIPPED", "TOO LARGE")
+
+##########################
+#        FUNCTIONS       #
+##########################
+
+# CKAN leaves blank fields as None or "", the index spells both as "NULL".
+def or_null(series):
+    return series.where(series.notna() & (series != ""), "NULL")
+
+# Works out how to read a downloaded file from its first few kilobytes:
+# compression, text encoding, JSON or delimited text, the delimiter, the columns and about how many rows.
+def inspect_file(filename):
+    size = os.path.getsize(filename)
+    with open(filename, 'rb') as raw:
+        compression = compression_of(raw.read(4))
+        raw.seek(0)
+        if compression == "gzip":
+            with gzip.GzipFile(fileobj=raw) as stream:
+                sample = stream.read(SAMPLE_SIZE)
+                at_end = stream.read(1) == b""
+            # gzip ends with the uncompressed size (modulo 4 GiB), which is close enough for an estimate
+            raw.seek(-4, os.SEEK_END)
+            size = int.from_bytes(raw.read(4), "little")
+        elif compression == "zstd":
+            # the frame header usually carries the uncompressed size
+            content_size = zstandard.frame_content_size(raw.read(18))
+            raw.seek(0)
+            if content_size > 0:
+                size = content_size
+            with zstandard.ZstdDecompressor().stream_reader(raw, closefd=False) as stream:
+                sample = stream.read(SAMPLE_SIZE)
+                at_end = stream.read(1) == b""
+        else:
+            sample = raw.read(SAMPLE_SIZE)
+            at_end = raw.read(1) == b""
+
+    # a byte order mark settles the encoding, otherwise try UTF-8 and fall back to Latin-1
+    if sample.startswith(codecs.BOM_UTF8):
+        encoding = "utf-8-sig"
+    elif sample.startswith(codecs.BOM_UTF16_LE) or sample.startswith(codecs.BOM_UTF16_BE):
+        encoding = "utf-16"
+    else:
+        encoding = "utf-8"
+        try:
+            sample.decode(encoding)
+        except UnicodeDecodeError as error:
+            # the sample may just end part way through a character
+            if at_end or error.start < len(sample) - 3:
+                encoding = "latin-1"
+    text = sample.decode(encoding, errors='ignore')
+    lines = text.splitlines()
+
+    schema = {
+        'compression':compression,
+        'encoding':encoding,
+        'kind':"csv",
+        'delimiter':"",
+        'header':"",
+        'columns':[],
+        'row_estimate':None
+        }
+    if text.lstrip()[:1] in ("[", "{"):
+        # JSON: the columns are the keys of the first record
+        schema['kind'] = "json"
+        body = text.lstrip()
+        try:
+            if body[0] == "[":
+                first, end = json.JSONDecoder().raw_decode(body, len(body) - len(body[1:].lstrip()))
+            else:
+                first, end = json.JSONDecoder().raw_decode(body)
+            if isinstance(first, dict):
+                schema['columns'] = list(first.keys())
+        except ValueError:
+            pass
+        return schema
+    if lines:
+        schema['header'] = lines[0]
+        # let the csv module pick the delimiter from a few whole lines, comma if it cannot tell
+        try:
+            schema['delimiter'] = csv.Sniffer().sniff("\n".join(lines[:20]), delimiters=",;\t|").delimiter
+        except csv.Error:
+            schema['delimiter'] = ","
+        schema['columns'] = next(csv.reader([lines[0]], delimiter=schema['delimiter']))
+        if at_end:
+            schema['row_estimate'] = len(lines) - 1
+        else:
+            schema['row_estimate'] = int(len(lines) * size / max(len(sample), 1)) - 1
+    return schema
+
+# Names the compression a file's first four bytes show ("" for none, or zstd we cannot read).
+def compression_of(magic):
+    if magic[:2] == b"\x1f\x8b":
+        return "gzip"
+    elif magic == b"\x28\xb5\x2f\xfd" and zstandard is not None:
+        return "zstd"
+    return ""
+
+def per_second(amount, seconds):
+    if seconds > 0:
+        return amount / seconds
+    return 0.0
+
+# Copies the matching columns of one dataset into its "_filtered" files, a chunk of rows at a time.
+# "targets" lists a (filtered file, organization) pair for every package that shares this dataset.
+# Runs in its own process, so it hands back what it would have printed.
+def column_filter(old_file, targets, search_criteria, filter_criteria, chunk_size):
+    messages = ["+ Searching '" + old_file + "'"]
+    rows = 0
+    try:
+        # read just the header row to decide what, if anything, to keep
+        columns = pandas.read_csv(old_file, nrows=0).columns
+        has_names = False
+        selected = []
+        for column_name in columns:
+            for word in search_criteria:
+                if word in column_name.lower():
+                    has_names = True
+            for word in filter_criteria:
+                if word in column_name.lower():
+                    selected.append(column_name)
+                    break
+        if has_names == False:
+            messages.append("  - No names found.")
+            return messages, rows
+        messages.append("  - Found data in '" + old_file + "'")
+        temps = [open(new_file + ".part", 'w', newline='') for new_file, organization in targets]
+        try:
+            if selected:
+                # read the dataset once, however many packages share it
+                # (as plain text, so every chunk writes each value exactly as the file had it)
+                header = True
+                for chunk in pandas.read_csv(old_file, usecols=selected, chunksize=chunk_size, dtype=str, keep_default_na=False):
+                    chunk = chunk[selected]
+                    rows += len(chunk)
+                    for temp, (new_file, organization) in zip(temps, targets):
+                        chunk.insert(0, "org_index", organization)
+                        chunk.to_csv(temp, index=False, header=header)
+                        del chunk["org_index"]
+                    header = False
+            else:
+                # nothing matched the filter, so all that is left is the organization column
+                for temp in temps:
+                    temp.write("org_index\n")
+        finally:
+            for temp in temps:
+                temp.close()
+        for new_file, organization in targets:
+            os.replace(new_file + ".part", new_file)
+            messages.append("  - Saving data at '" + new_file + "'")
+    except FileNotFoundError:
+        messages.append("  - File '" + old_file + "' does not exist.")
+    except (pandas.errors.ParserError, pandas.errors.EmptyDataError, UnicodeDecodeError) as error:
+        messages.append("  - Could not read '" + old_file + "': " + str(error).strip())
+        # a chunk part way through can fail, so drop what was written and count nothing
+        for new_file, organization in targets:
+            if exists(new_file + ".part"):
+                os.remove(new_file + ".part")
+        rows = 0
+    return messages, rows
+
+# Downloads one resource, then files it in the store.
+# "previous" is this file's manifest entry from the last run, or None.
+def resource_downloader(session, i, url, filename, blob_path, timeout, max_bytes, previous):
+    started = time.perf_counter()
+    i, result, details = fetch_resource(session, i, url, filename, timeout, max_bytes, previous)
+    # how long the request took, not counting storing the file
+    details = dict(details, Seconds=time.perf_counter() - started)
+    if result == "FETCHED":
+        # a file we cannot store fails on its own instead of stopping the whole batch
+        try:
+            details['SHA256'] = store_download(filename, blob_path, details.pop('Checksum'))
+            result = "GOOD"
+        except OSError as error:
+            result = "FAILED"
+            details['Error'] = str(error)
+    return i, result, details
+
+# Streams one resource into data/<i>.<ext>.part, resuming it if an earlier attempt left one behind.
+def fetch_resource(session, i, url, filename, timeout, max_bytes, previous):
+    # stream into a temporary file so a crash never leaves a truncated dataset behind
+    # (it holds the data as downloaded, compression for storage happens once it is complete)
+    temp_filename = filename + ".part"
+    # the sidecar remembers where a partial file came from so it can be resumed
+    state_filename = temp_filename + ".json"
+    try:
+        state = load_partial(url, temp_filename, state_filename)
+        with session.get(url, timeout=timeout, stream=True, headers=request_headers(state, previous)) as file:
+            # a "304" code means our copy is current, so keep what we recorded last time
+            if file.status_code == 304 and previous and not state:
+                return i, "UNCHANGED", previous
+            # a "206" code means the server is sending only the bytes we are missing
+            if file.status_code == 206 and state and resumes_at(file, state['Size']):
+                mode = 'ab'
+                size = state['Size']
+                checksum = state['Checksum']
+            # a "200" code means a full copy, so whatever we had is thrown away
+            elif file.status_code == 200:
+                mode = 'wb'
+                size = 0
+                checksum = hashlib.sha256()
+            # a "416" code (or a range we did not ask for) means the partial file is no good
+            elif state and file.status_code in (206, 416):
+                discard_partial(temp_filename, state_filename)
+                return i, "FAILED", {'Error': "HTTP " + str(file.status_code) + " resuming, partial file discarded"}
+            # anything else is reported back instead of saved
+            else:
+                return i, "FAILED", {'Error': "HTTP " + str(file.status_code)}
+            # refuse oversized files up front when the server tells us the size
+            length = file.headers.get('Content-Length')
+            if max_bytes and length and size + int(length) > max_bytes:
+                discard_partial(temp_filename, state_filename)
+                return i, "TOO LARGE", {'Error': str(size + int(length)) + " bytes"}
+            etag = file.headers.get('ETag', "")
+            last_modified = file.headers.get('Last-Modified', "")
+            # record where this file comes from before the first byte lands
+            # (through a temporary file, so a crash cannot leave half a sidecar)
+            with open(state_filename + ".part", 'w') as state_file:
+                json.dump({'URL': url, 'ETag': etag, 'Last-Modified': last_modified}, state_file)
+            os.replace(state_filename + ".part", state_filename)
+            # undo any Content-Encoding ourselves, so we can count the bytes as they crossed the network
+            decoder = ContentDecoder(file.headers.get('Content-Encoding', ""))
+            with open(temp_filename, mode) as temp:
+                for chunk in decoder.chunks(file.raw.stream(CHUNK_SIZE, decode_content=False)):
+                    size += len(chunk)
+                    # servers do not always send a Content-Length, so keep counting
+                    if max_bytes and size > max_bytes:
+                        temp.close()
+                        discard_partial(temp_filename, state_filename)
+                        return i, "TOO LARGE", {'Error': "over " + str(max_bytes) + " bytes"}
+                    checksum.update(chunk)
+                    temp.write(chunk)
+            transferred = decoder.transferred
+    except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError, zlib.error, OSError) as error:
+        # keep the partial file, the next run picks up where this one stopped
+        return i, "FAILED", {'Error': str(error)}
+    return i, "FETCHED", {
+        'Size': size,
+        'Transferred': transferred,
+        'Checksum': checksum.hexdigest(),
+        'ETag': etag,
+        'Last-Modified': last_modified
+        }
+
+# Keeps one copy per distinct content (named like data/<i>.<ext>) and points this package's file at it.
+def store_download(filename, blob_path, checksum):
+    temp_filename = filename + ".part"
+    blob = blob_path + checksum + "." + os.path.basename(filename).split(".", 1)[1]
+    if exists(blob):
+        os.remove(temp_filename)
+    else:
+        store_blob(temp_filename, blob)
+    link_blob(blob, filename)
+    os.remove(temp_filename + ".json")
+    return checksum
+
+# Points a file under data/ at a stored copy, replacing whatever was there in one step.
+# A hard link costs nothing, a symbolic link is the next best thing, and a copy always works.
+def link_blob(blob, filename):
+    # already pointing there (renaming one hard link over another would do nothing anyway)
+    if exists(filename) and os.path.samefile(blob, filename):
+        return
+    link_filename = filename + ".link"
+    if os.path.lexists(link_filename):
+        os.remove(link_filename)
+    try:
+        os.link(blob, link_filename)
+    except OSError:
+        try:
+            os.symlink(os.path.abspath(blob), link_filename)
+        except OSError:
+            shutil.copyfile(blob, link_filename)
+    os.replace(link_filename, filename)
+    return
+
+# Returns what we know about a partial download of url, or None if there is nothing to resume.
+def load_partial(url, temp_filename, state_filename):
+    if not exists(temp_filename) or not exists(state_filename):
+        return None
+    # a sidecar we cannot read tells us nothing, so start the file over
+    try:
+        with open(state_filename) as state_file:
+            state = json.load(state_file)
+        trusted = state['URL'] == url and (state['ETag'] or state['Last-Modified'])
+    except (ValueError, KeyError, TypeError):
+        discard_partial(temp_filename, state_filename)
+        return None
+    # a partial file from some other URL, or one the server gave no validator for, cannot be trusted
+    if not trusted:
+        return None
+    # hash what we already have so the finished checksum covers the whole file
+    state['Size'] = os.path.getsize(temp_filename)
+    state['Checksum'] = hash_file(temp_filename)
+    return state
+
+# Returns a SHA-256 of a file's contents, read a chunk at a time.
+# Files we compressed ourselves are hashed as they were downloaded, so the hash does not depend on how they are stored.
+def hash_file(filename):
+    checksum = hashlib.sha256()
+    with open_stored(filename) as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+            checksum.update(chunk)
+    return checksum
+
+# Opens a file under data/ for reading in binary, undoing the compression its name says we applied.
+def open_stored(filename):
+    if filename.endswith(COMPRESSION_SUFFIX["gzip"]):
+        return gzip.open(filename, 'rb')
+    elif filename.endswith(COMPRESSION_SUFFIX["zstd"]):
+        return zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'))
+    return open(filename, 'rb')
+
+# Moves a finished download into the store, compressing it on the way if the blob name asks for it.
+# Two downloads with the same contents can get here at once, and either one ending up as the blob is fine.
+def store_blob(temp_filename, blob):
+    # compress next to this download, never to a name another thread could be writing too
+    compressed_filename = temp_filename + os.path.splitext(blob)[1]
+    if blob.endswith(COMPRESSION_SUFFIX["gzip"]):
+        with open(temp_filename, 'rb') as source, gzip.open(compressed_filename, 'wb') as target:
+            shutil.copyfileobj(source, target, CHUNK_SIZE)
+    elif blob.endswith(COMPRESSION_SUFFIX["zstd"]):
+        with open(temp_filename, 'rb') as source, open(compressed_filename, 'wb') as target:
+            zstandard.ZstdCompressor().copy_stream(source, target, read_size=CHUNK_SIZE)
+    else:
+        os.replace(temp_filename, blob)
+        return
+    os.replace(compressed_filename, blob)
+    os.remove(temp_filename)
+    return
+
+# Builds the extra request headers for a resume or a conditional download.
+def request_headers(state, previous):
+    headers = {}
+    if state:
+        # ask for the rest of the file, but only if it is still the same file
+        headers['Range'] = "bytes=" + str(state['Size']) + "-"
+        headers['If-Range'] = state['ETag'] or state['Last-Modified']
+        # byte offsets only line up with what we saved if the body is not re-encoded
+        headers['Accept-Encoding'] = "identity"
+    elif previous:
+        # ask the server to skip the body if our copy is still current
+        if previous['ETag']:
+            headers['If-None-Match'] = previous['ETag']
+        if previous['Last-Modified']:
+            headers['If-Modified-Since'] = previous['Last-Modified']
+    return headers
+
+# Checks that a "206" response starts right where our partial file ends.
+def resumes_at(response, offset):
+    content_range = response.headers.get('Content-Range', "")
+    return content_range.startswith("bytes " + str(offset) + "-")
+
+def discard_partial(temp_filename, state_filename):
+    for name in [temp_filename, state_filename]:
+        if exists(name):
+            os.remove(name)
+    return
 
 ##########################
 #         CLASSES        #
 ##########################
 
+# Undoes a response's gzip or deflate Content-Encoding as its raw bytes arrive, counting them on the way.
+# (urllib3 can do both, but does not count the bytes of chunked responses, which is how most compressed ones arrive.)
+class ContentDecoder:
+
+    def __init__(self, encoding):
+        self.encoding = encoding.strip().lower()
+        # bytes as they crossed the network
+        self.transferred = 0
+        return
+
+    def chunks(self, raw_chunks):
+        # Yields the decoded body, a chunk at a time
+        decompressor = None
+        for data in raw_chunks:
+            self.transferred += len(data)
+            if self.encoding not in ("gzip", "x-gzip", "deflate"):
+                yield data
+                continue
+            while data:
+                if decompressor is None:
+                    decompressor = self.decompressor(data)
+                decoded = decompressor.decompress(data)
+                if decoded:
+                    yield decoded
+                # a gzip body can be several members one after another
+                data = b""
+                if decompressor.eof:
+                    data = decompressor.unused_data
+                    decompressor = None
+        if decompressor is not None:
+            decoded = decompressor.flush()
+            if decoded:
+                yield decoded
+        return
+
+    def decompressor(self, data):
+        # gzip and zlib headers are recognised by zlib itself, "deflate" without a header is raw deflate
+        if data[:2] == b"\x1f\x8b" or (data[0] & 0x0F == 8 and int.from_bytes(data[:2], "big") % 31 == 0):
+            return zlib.decompressobj(32 + zlib.MAX_WBITS)
+        return zlib.decompressobj(-zlib.MAX_WBITS)
+
+# Times each stage of a run and counts what it did, then writes it all out as a JSON report.
+class GovDataMetrics:
+
+    def __init__(self, profile_path=None):
+        self.started = time.time()
+        self.phases = {}
+        self.counters = {}
+        self.requests = {}
+        self.hosts = {}
+        # when set, each phase also runs under cProfile and its stats are saved there
+        self.profile_path = profile_path
+        if profile_path and not exists(profile_path):
+            os.makedirs(profile_path)
+        self.lock = threading.Lock()
+        # names of the phases under way, innermost last (phases are only timed from the main thread)
+        self.running = []
+        return
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        # Time everything inside the "with" block as one phase of the run
+        # A phase inside another (catalog pages fetched while enumerating) is taken out of the outer one,
+        # so the phases add up to the run, and it shows up in the outer phase's profile.
+        profiling = self.profile_path and not self.running
+        if profiling:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        self.running.append(name)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            self.running.pop()
+            if profiling:
+                profiler.disable()
+                profiler.dump_stats(self.profile_path + name + ".prof")
+            with self.lock:
+                totals = self.phases.setdefault(name, {'seconds': 0.0, 'calls': 0})
+                totals['seconds'] += seconds
+                totals['calls'] += 1
+                if self.running:
+                    outer = self.phases.setdefault(self.running[-1], {'seconds': 0.0, 'calls': 0})
+                    outer['seconds'] -= seconds
+        return
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+        return
+
+    def request(self, kind, host, seconds, transferred, failed=False):
+        # One HTTP request: its latency goes into a histogram, its bytes and errors are added up per host
+        with self.lock:
+            totals = self.requests.setdefault(kind, {
+                'count': 0,
+                'errors': 0,
+                'seconds': 0.0,
+                'bytes': 0,
+                'histogram': [0] * (len(LATENCY_BUCKETS) + 1)
+                })
+            totals['count'] += 1
+            totals['errors'] += int(failed)
+            totals['seconds'] += seconds
+            totals['bytes'] += transferred
+            bucket = 0
+            while bucket < len(LATENCY_BUCKETS) and seconds > LATENCY_BUCKETS[bucket]:
+                bucket += 1
+            totals['histogram'][bucket] += 1
+            host_totals = self.hosts.setdefault(host, {'requests': 0, 'errors': 0, 'seconds': 0.0, 'bytes': 0})
+            host_totals['requests'] += 1
+            host_totals['errors'] += int(failed)
+            host_totals['seconds'] += seconds
+            host_totals['bytes'] += transferred
+        return
+
+    def report(self, filename):
+        # Write everything we measured, with throughput worked out, as JSON
+        labels = ["<= " + str(bound) + "s" for bound in LATENCY_BUCKETS] + ["> " + str(LATENCY_BUCKETS[-1]) + "s"]
+        requests_report = {}
+        for kind, totals in self.requests.items():
+            requests_report[kind] = dict(totals,
+                histogram=dict(zip(labels, totals['histogram'])),
+                bytes_per_second=per_second(totals['bytes'], totals['seconds']))
+        hosts_report = {}
+        for host, totals in self.hosts.items():
+            hosts_report[host] = dict(totals, bytes_per_second=per_second(totals['bytes'], totals['seconds']))
+        report = {
+            'started': time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+            'seconds': time.time() - self.started,
+            'phases': self.phases,
+            'counters': self.counters,
+            'requests': requests_report,
+            'hosts': hosts_report
+            }
+        # overall download rate across the whole download phase, with every connection working at once
+        if 'download' in self.phases and 'download' in self.requests:
+            report['download_bytes_per_second'] = per_second(self.requests['download']['bytes'], self.phases['download']['seconds'])
+        with open(filename, 'w') as file:
+            json.dump(report, file, indent=2)
+        return report
+
+# Remembers the schema of every file under data/ so column searches do not have to reopen them.
+class GovDataSchema:
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS files (
+            filename TEXT PRIMARY KEY,
+            sha256 TEXT,
+            size INTEGER,
+            mtime REAL,
+            compression TEXT,
+            encoding TEXT,
+            kind TEXT,
+            delimiter TEXT,
+            header TEXT,
+            row_estimate INTEGER
+            )''')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS columns (
+            filename TEXT,
+            position INTEGER,
+            name TEXT,
+            lower_name TEXT
+            )''')
+        self.connection.execute("CREATE INDEX IF NOT EXISTS columns_filename ON columns (filename)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS columns_lower_name ON columns (lower_name)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256)")
+        self.connection.commit()
+        return
+
+    def update(self, filename, checksum=None):
+        # Inspect a file only if it is new or its contents changed since we last looked
+        name = os.path.basename(filename)
+        stat = os.stat(filename)
+        row = self.connection.execute("SELECT size, mtime, sha256 FROM files WHERE filename = ?", (name,)).fetchone()
+        if row and row[0] == stat.st_size and row[1] == stat.st_mtime:
+            return False
+        if not checksum:
+            checksum = hash_file(filename).hexdigest()
+        if row and row[2] == checksum:
+            self.connection.execute("UPDATE files SET size = ?, mtime = ? WHERE filename = ?", (stat.st_size, stat.st_mtime, name))
+            self.connection.commit()
+            return False
+        self.connection.execute("DELETE FROM files WHERE filename = ?", (name,))
+        self.connection.execute("DELETE FROM columns WHERE filename = ?", (name,))
+        # the same contents under another name have already been inspected, so copy those results
+        # (all but the compression: hashes are taken uncompressed, so a twin may be stored another way)
+        twin = self.connection.execute("SELECT filename FROM files WHERE sha256 = ?", (checksum,)).fetchone()
+        if twin:
+            with open(filename, 'rb') as raw:
+                compression = compression_of(raw.read(4))
+            self.connection.execute('''INSERT INTO files SELECT ?, sha256, ?, ?, ?, encoding, kind, delimiter, header, row_estimate
+                FROM files WHERE filename = ?''', (name, stat.st_size, stat.st_mtime, compression, twin[0]))
+            self.connection.execute("INSERT INTO columns SELECT ?, position, name, lower_name FROM columns WHERE filename = ?", (name, twin[0]))
+            self.connection.commit()
+            return True
+        schema = inspect_file(filename)
+        self.connection.execute("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (
+            name, checksum, stat.st_size, stat.st_mtime, schema['compression'], schema['encoding'],
+            schema['kind'], schema['delimiter'], schema['header'], schema['row_estimate']))
+        self.connection.executemany("INSERT INTO columns VALUES (?, ?, ?, ?)",
+            [(name, position, column, column.lower()) for position, column in enumerate(schema['columns'])])
+        self.connection.commit()
+        return True
+
+    def forget(self, filename):
+        # Drop a file that is no longer on disk
+        name = os.path.basename(filename)
+        self.connection.execute("DELETE FROM files WHERE filename = ?", (name,))
+        self.connection.execute("DELETE FROM columns WHERE filename = ?", (name,))
+        self.connection.commit()
+        return
+
+    def search(self, terms):
+        # Names of every file with at least one column containing any of the terms
+        matches = set()
+        for term in terms:
+            # instr() matches the term literally, LIKE would treat "_" and "%" in it as wildcards
+            rows = self.connection.execute("SELECT DISTINCT filename FROM columns WHERE instr(lower_name, ?) > 0", (term.lower(),))
+            matches.update(row[0] for row in rows)
+        return matches
+
+    def header(self, filename):
+        # The header line we recorded for a file, or None if we have never seen it
+        row = self.connection.execute("SELECT header FROM files WHERE filename = ?", (os.path.basename(filename),)).fetchone()
+        if row:
+            return row[0]
+        return None
+
 class GovDataCollector:
 
-    def __init__(self, search_term, max_records, path):
-        self.width = os.get_terminal_size()[0]
+    def __init__(self, search_term, max_records, path, page_size=1000, cache_ttl=0, offline=False, compression="", metrics=None, catalog_url="https://catalog.data.gov/api/3"):
+        # falls back to 80 columns when output is not a terminal
+        self.width = shutil.get_terminal_size()[0]
         self.path = path
         self.data_path = path + "data/"
+        # timers and counters for the run report
+        if metrics == None:
+            metrics = GovDataMetrics()
+        self.metrics = metrics
+        self.cache_path = path + "cache/"
+        # one copy of each distinct file, named by its SHA-256
+        self.blob_path = self.data_path + "blobs/"
         # create directory if it does not exist
         if not exists(self.path):
             os.mkdir(self.path)
         if not exists(self.data_path):
             os.mkdir(self.data_path)
+        if not exists(self.blob_path):
+            os.mkdir(self.blob_path)
+        if not exists(self.cache_path):
+            os.mkdir(self.cache_path)
         # Set search criteria via query for url
-        # URL = https://catalog.data.gov/api/3//action/package_search?q=salary&fq=groups:local&rows=200
-        url  = "https://catalog.data.gov/api/3" # base URL for data.gov API
-        url += "/action/package_search?"        # search within the packages
-        url += "q=" + search_term               # search for term "salary"
-        url += "&fq=groups:local"               # filter for "local-government"
-        url += "&rows=" + str(max_records)      # show the first 200 results
+        # URL = https://catalog.data.gov/api/3//action/package_search?q=salary&fq=groups:local&rows=200&start=0
+        self.url  = catalog_url                      # base URL for data.gov API
+        self.url += "/action/package_search?"        # search within the packages
+        self.url += "q=" + search_term               # search for term "salary"
+        self.url += "&fq=groups:local"               # filter for "local-government"
 
         # Prevents us from looking like python
-        header = {
-            'User-Agent': 'Mozilla/5.0'
+        self.header = {
+            'User-Agent': 'Mozilla/5.0',
+            # let publishers compress what they send, in the encodings ContentDecoder can undo
+            'Accept-Encoding': "gzip, deflate"
         }
-        # Make the HTTP request.
+        # CKAN caps "rows" per request (1000 on data.gov), so we walk the catalog in pages
+        self.page_size = page_size
+        self.max_records = max_records
+        self.save_pages = False
+        # seconds to wait on a publisher (connect, read) before giving up on a file
+        self.timeout = (10, 60)
+        # a crawl whose first page is younger than cache_ttl seconds is read from disk instead of the API
+        # (off by default, a nightly run should see tonight's catalog)
+        self.cache_ttl = cache_ttl
+        # offline runs only use cached catalog pages and files already in data/
+        self.offline = offline
+        # store datasets as they come ("") or compressed with "gzip" or "zstd"
+        assert compression in COMPRESSION_SUFFIX, "Unknown compression " + compression
+        assert compression != "zstd" or zstandard is not None, "zstd compression needs the zstandard package"
+        self.compression = compression
+        # column names of every downloaded file, kept up to date as files arrive
+        self.schema = GovDataSchema(self.path + "Schema.db")
+
+        # Make the HTTP request for the first page.
         self.msg("Requesting the Data.Gov catalog")
-        self.response = requests.get(url, headers=header)
-        assert self.response.status_code == 200
+        self.response = self.request_page(0, self.page_rows(0))
+        self.response_dict = json.loads(self.response)
 
-        # Use the json module to load CKAN's response into a dictionary.
-        self.response_dict = self.response.json()
+        # Stop at whichever comes first: the end of the catalog or max_records (0 = everything)
+        self.total = self.response_dict['result']['count']
+        if self.max_records > 0:
+            self.total = min(self.total, self.max_records)
+        print("+ Found " + str(self.response_dict['result']['count']) + " packages, collecting " + str(self.total))
+        return
+
+    def page_rows(self, start):
+        # never ask for more than the page size or more than we have left to collect
+        rows = self.page_size
+        if self.max_records > 0:
+            rows = min(rows, self.max_records - start)
+        return rows
+
+    def request_page(self, start, rows):
+        # Returns the raw JSON text for one page of the catalog, from the cache when we can
+        url = self.url + "&rows=" + str(rows) + "&start=" + str(start)
+        cache_file = self.cache_path + hashlib.sha256(url.encode()).hexdigest() + ".json"
+        if exists(cache_file):
+            saved = os.path.getmtime(cache_file)
+            if start == 0:
+                # the first page sets the count, so it decides how fresh the whole crawl is
+                fresh = time.time() - saved < self.cache_ttl
+            else:
+                # later pages only if they were saved with that first page, so the crawl is one snapshot
+                fresh = saved >= self.snapshot
+            if self.offline or fresh:
+                if start == 0:
+                    self.snapshot = saved
+                self.metrics.count("catalog pages from cache")
+                with open(cache_file) as file:
+                    return file.read()
+        assert not self.offline, "No cached catalog page for " + url + ", run once without --offline first"
+
+        started = time.perf_counter()
+        # read the body through ContentDecoder so the bytes are counted as they crossed the network, like downloads
+        with requests.get(url, headers=self.header, stream=True) as response:
+            decoder = ContentDecoder(response.headers.get('Content-Encoding', ""))
+            text = b"".join(decoder.chunks(response.raw.stream(CHUNK_SIZE, decode_content=False))).decode("utf-8")
+        self.metrics.request("catalog", urlparse(url).netloc, time.perf_counter() - started, decoder.transferred, response.status_code != 200)
+        assert response.status_code == 200
 
         # Check the contents of the response.
-        assert self.response_dict['success'] is True
-        self.result = self.response_dict['result']['results']
-        return
+        assert json.loads(text)['success'] is True
+
+        # Cache the page, writing to a temporary file first so a crash cannot leave half a page
+        with open(cache_file + ".part", 'w') as file:
+            file.write(text)
+        os.replace(cache_file + ".part", cache_file)
+        if start == 0:
+            self.snapshot = os.path.getmtime(cache_file)
+        return text
+
+    def crawl(self):
+        # Generator over every page of package records, fetching the next page only when needed
+        start = 0
+        page = self.response_dict
+        while True:
+            records = page['result']['results']
+            yield records
+            start += len(records)
+            if len(records) == 0 or start >= self.total:
+                return
+            rows = self.page_rows(start)
+            print("+ Requesting catalog records " + str(start + 1) + " to " + str(min(start + rows, self.total)))
+            # later pages are still part of querying the catalog, even though enumerate() asks for them
+            with self.metrics.phase("catalog"):
+                response = self.request_page(start, rows)
+            if self.save_pages:
+                self.save_page(response, start)
+            page = json.loads(response)
 
     def msg(self, message):
         print()
@@ -74,17 +792,30 @@ class GovDataCollector:
         print()
         return
 
+    def data_file(self, i):
+        # Where the dataset for package i lives, e.g. data/3.csv or data/3.csv.gz
+        return self.data_path + str(i) + self.format + COMPRESSION_SUFFIX[self.compression]
+
     def save_response(self):
         # Save raw JSON index for catalog
-        buffer = self.response.text
-        filename = self.path + "Response.json"
-        file = open(filename, 'w')
-        file.write(buffer)
-        file.close()
+        filename = self.save_page(self.response, 0)
+        # Later pages are saved as the crawl reaches them
+        self.save_pages = True
         self.msg("Catalog request was saved at " + filename)
         return
 
-    def enumerate(self, format, download):
+    def save_page(self, response, start):
+        # The first page keeps the original name, later pages are numbered by their offset
+        if start == 0:
+            filename = self.path + "Response.json"
+        else:
+            filename = self.path + "Response_" + str(start) + ".json"
+        file = open(filename, 'w')
+        file.write(response)
+        file.close()
+        return filename
+
+    def enumerate(self, format):
 
         self.msg("Enumerating catalog details")
 
@@ -95,101 +826,326 @@ class GovDataCollector:
             self.mimetype = "application/json"
             self.format = ".json"
 
-        # Enumerate packages
-        self.publishers = []
-        self.organizations = []
-        self.maintainers = []
-        self.maint_emails = []
-        self.file_url = []
-        self.create_date = []
-        self.modify_date = []
-
-        for record in self.result:
-            if record['maintainer']:
-                self.maintainers.append(record['maintainer'])
-            else: self.maintainers.append("NULL")
-            if record['maintainer_email']:
-                self.maint_emails.append(record['maintainer_email'])
-            else: self.maint_emails.append("NULL")
-            extras = record['extras']
-            placeholder = "NULL"
-            create = "NULL"
-            modify = "NULL"
-            if extras:
-                for i in extras:
-                    key = i['key']
-                    value = i['value']
-                    if key == 'publisher':
-                        placeholder = value
-                    if key == 'issued':
-                        create = value
-                    if key == 'modified':
-                        modify = value
-            self.publishers.append(placeholder)
-            self.create_date.append(create)
-            self.modify_date.append(modify)
-            resources = record['resources']
-            placeholder = "NULL"
-            if resources:
-                for j in resources:
-                    if j['mimetype'] == self.mimetype:
-                        placeholder = j['url']
-                        break
-                    else: continue
-            self.file_url.append(placeholder)
-            org = record['organization']['name']
-            placeholder = "NULL"
-            if org:
-                placeholder = org
-            self.organizations.append(placeholder)
+        # Flatten the catalog one page at a time, then stack the pages
+        # (each call walks the catalog afresh, later pages come from the cache)
+        # Downloads still wait for the whole index: resuming a batch and sharing files between
+        # packages both work from the complete list of URLs.
+        packages = []
+        resources = []
+        start = 0
+        for records in self.crawl():
+            page_packages, page_resources = self.flatten_page(records, start)
+            self.metrics.count("packages enumerated", len(page_packages))
+            self.metrics.count("resources enumerated", len(page_resources))
+            packages.append(page_packages)
+            resources.append(page_resources)
+            start += len(records)
 
         # Save publisher data to index file
-        self.index_filename = self.path + "Index.xlsx"
-
-        self.index_writer = pandas.ExcelWriter(self.index_filename, engine = 'xlsxwriter')
-
-        self.tbl_publishers = pandas.DataFrame({
-            'Publisher':self.publishers,
-            'Organization':self.organizations,
-            'Maintainer':self.maintainers,
-            'Maintainer E-Mail':self.maint_emails,
-            'URL':self.file_url,
-            'Create Date':self.create_date,
-            'Modify Date':self.modify_date
-            })
+        self.index_filename = self.path + "Index.parquet"
+        self.headers_filename = self.path + "Headers.parquet"
+        self.resources_filename = self.path + "Resources.parquet"
+
+        self.tbl_publishers = pandas.concat(packages)
         self.tbl_publishers.index.rename('Key', inplace=True)
-        self.tbl_publishers.to_excel(self.index_writer, sheet_name = 'Publishers')
-        if download == False:
-            self.index_writer.save()
+
+        # Every resource of every package, whatever its format, so picking another format is just a query
+        self.tbl_resources = pandas.concat(resources, ignore_index=True)
+        self.tbl_resources.to_parquet(self.resources_filename, engine='pyarrow', index=False)
+
+        # Later stages work from these columns
+        self.publishers = self.tbl_publishers['Publisher'].tolist()
+        self.organizations = self.tbl_publishers['Organization'].tolist()
+        self.maintainers = self.tbl_publishers['Maintainer'].tolist()
+        self.maint_emails = self.tbl_publishers['Maintainer E-Mail'].tolist()
+        self.file_url = self.tbl_publishers['URL'].tolist()
+        self.create_date = self.tbl_publishers['Create Date'].tolist()
+        self.modify_date = self.tbl_publishers['Modify Date'].tolist()
+
+        # download() saves it again once every file has a status
+        self.save_index()
         return
 
-    def download(self, index=None):
+    def flatten_page(self, records, start):
+        # One row per package, keyed by its position in the catalog
+        packages = pandas.DataFrame.from_records(records, columns=['id', 'maintainer', 'maintainer_email', 'organization'])
+        packages.index = pandas.RangeIndex(start, start + len(packages))
+        keys = pandas.Series(packages.index, index=packages['id'])
+
+        # One row per extra, pivoted so each key we care about becomes a column (the last value wins)
+        extras = pandas.json_normalize(records, 'extras', meta='id', meta_prefix='package.')
+        extras = extras.reindex(columns=['package.id', 'key', 'value'])
+        extras = extras[extras['key'].isin(['publisher', 'issued', 'modified'])]
+        extras = extras.drop_duplicates(['package.id', 'key'], keep='last')
+        extras = extras.pivot(index='package.id', columns='key', values='value')
+        extras = extras.reindex(index=packages['id'], columns=['publisher', 'issued', 'modified'])
+
+        # One row per resource, in the order CKAN lists them
+        resources = pandas.json_normalize(records, 'resources', meta='id', meta_prefix='package.')
+        resources = resources.reindex(columns=['package.id', 'format', 'mimetype', 'url'])
+        resources.insert(0, 'Key', resources['package.id'].map(keys))
+        resources = resources.drop(columns='package.id')
+        resources.columns = ['Key', 'Format', 'Mimetype', 'URL']
+
+        # The file we download is the first resource with the mimetype we asked for
+        urls = resources[resources['Mimetype'] == self.mimetype].drop_duplicates('Key').set_index('Key')['URL']
+
+        table = pandas.DataFrame({
+            'Publisher':extras['publisher'].fillna("NULL").values,
+            'Organization':or_null(packages['organization'].str.get('name')).values,
+            'Maintainer':or_null(packages['maintainer']).values,
+            'Maintainer E-Mail':or_null(packages['maintainer_email']).values,
+            'URL':or_null(urls.reindex(packages.index)).values,
+            'Create Date':extras['issued'].fillna("NULL").values,
+            'Modify Date':extras['modified'].fillna("NULL").values
+            }, index=packages.index)
+        return table, resources
+
+    def save_index(self):
+        # Parquet is columnar, so later stages can read just the columns they need
+        self.tbl_publishers.to_parquet(self.index_filename + ".part", engine='pyarrow')
+        os.replace(self.index_filename + ".part", self.index_filename)
+        print("+ Index saved at " + self.index_filename)
+        return
+
+    def load_index(self, columns=None):
+        # Read the index back, optionally just some of its columns
+        return pandas.read_parquet(self.index_filename, engine='pyarrow', columns=columns)
+
+    def export_excel(self):
+        # Only on request: xlsx is slow to write and capped at about a million rows
+        filename = self.path + "Index.xlsx"
+        with pandas.ExcelWriter(filename, engine='xlsxwriter') as writer:
+            self.load_index().to_excel(writer, sheet_name = 'Publishers')
+            # only headers matched in this run, Headers.parquet may be left over from another search
+            if hasattr(self, 'tbl_headers'):
+                self.tbl_headers.to_excel(writer, sheet_name = 'Matched_Headers', index=False)
+        self.msg("Index was exported to " + filename)
+        return
+
+    def download(self, index=None, workers=8, host_workers=2, max_bytes=None, autosave=100):
         self.msg("Starting downloads.  Good luck and Godspeed...")
 
+        # with no slots nothing could ever be handed out
+        assert workers >= 1 and host_workers >= 1, "Need at least one worker and one per host"
+
         if index == None:
             # Download ALL files
-            for i in range(0,len(self.file_url)):
-                if self.file_url[i] != "NULL":
-                    url = self.file_url[i]
-                    filename = self.data_path + str(i) + self.format
-                    print("+ Downloading " + str(i+1) + " of " + str(len(self.file_url)) + " from " + url)
-                    file = requests.get(url)
-                    print("  - Saving as " + filename)
-                    open(filename, 'wb').write(file.content)
-                else:
-                    print("+ Skipping " + str(i+1) + " of " + str(len(file_url)))
+            indexes = range(0,len(self.file_url))
         else:
             # Download just the file we need
-            url = self.file_url[index]
-            filename = self.data_path + str(index) + self.format
-            print("+ Downloading " + str(index) + " from " + url)
-            file = requests.get(url)
-            print("  - Saving as " + filename)
-            open(filename, 'wb').write(file.content)
+            indexes = [index]
+
+        # Track the outcome of every file in the index table, starting over only for the files we fetch now
+        for column, blank in [('Status', "UNKNOWN"), ('Error', ""), ('Size', 0), ('Transferred', 0), ('SHA256', ""), ('ETag', ""), ('Last-Modified', "")]:
+            if column not in self.tbl_publishers:
+                self.tbl_publishers[column] = blank
+            self.tbl_publishers.loc[list(indexes), column] = blank
+
+        # What we downloaded last time, so unchanged files can be skipped
+        self.load_manifest()
+
+        if self.offline:
+            # Nothing is fetched, we just note which files we already have
+            self.use_local_files(index)
+            self.save_index()
+            self.msg("Offline, so only files already in " + self.data_path + " will be used.")
+            return
+
+        # A batch that was interrupted leaves its progress behind
+        self.backup_filename = self.path + "Download_backup.csv"
+        self.autosave = autosave
+
+        if index == None:
+            # starting from the first file the last run did not finish
+            self.load_backup()
+
+        # Packages that point at the same URL are fetched once and linked to each other
+        self.duplicates = {}
+        first_index = {}
+        for i in indexes:
+            if self.tbl_publishers['Status'][i] in FINISHED:
+                continue
+            elif self.file_url[i] == "NULL":
+                print("+ Skipping " + str(i+1) + " of " + str(len(self.file_url)))
+                self.tbl_publishers.at[i, 'Status'] = "SKIPPED"
+            elif self.file_url[i] in first_index:
+                self.duplicates[first_index[self.file_url[i]]].append(i)
+            else:
+                first_index[self.file_url[i]] = i
+                self.duplicates[i] = []
+
+        # Queue each host's files separately, so a slow host only ever ties up its own slots
+        queues = {}
+        for url, i in first_index.items():
+            previous = self.manifest_entry(i)
+            if previous and not previous['ETag'] and not previous['Last-Modified'] and previous['Modify Date'] != "NULL" and previous['Modify Date'] == self.modify_date[i]:
+                # the server gave us nothing to check against, but the catalog says nothing changed
+                self.finish_download(i, "UNCHANGED", previous)
+                continue
+            queues.setdefault(urlparse(url).netloc, collections.deque()).append((i, url, previous))
+        busy = dict.fromkeys(queues, 0)
+
+        # One session shared by every thread, keeping a connection pool open per host
+        session = requests.Session()
+        session.headers.update(self.header)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=max(len(queues), 1), pool_maxsize=host_workers)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+
+        # create a thread pool executor
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            running = {}
+            count = 0
+            while queues or running:
+                # hand free workers to hosts with a free slot, one file per host in turn,
+                # so no worker ever sits waiting on a busy host
+                submitted = True
+                while submitted and len(running) < workers:
+                    submitted = False
+                    for host in list(queues):
+                        if len(running) >= workers:
+                            break
+                        if busy[host] >= host_workers:
+                            continue
+                        i, url, previous = queues[host].popleft()
+                        if not queues[host]:
+                            del queues[host]
+                        busy[host] += 1
+                        running[executor.submit(resource_downloader, session, i, url, self.data_file(i), self.blob_path, self.timeout, max_bytes, previous)] = host
+                        submitted = True
+                # report each file as soon as it finishes, in whatever order that is
+                done, pending = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for instance in done:
+                    busy[running.pop(instance)] -= 1
+                    i, result, details = instance.result()
+                    self.metrics.request("download", urlparse(self.file_url[i]).netloc, details['Seconds'], details.get('Transferred', 0), result == "FAILED")
+                    self.finish_download(i, result, details)
+                    count += 1
+                    # if we hit the autosave number
+                    if count % self.autosave == 0:
+                        # save the backup
+                        self.tbl_publishers.to_csv(self.backup_filename)
+                        self.save_manifest()
+        session.close()
+        self.save_manifest()
+        self.prune_blobs()
+        # the batch is done, so there is nothing left to resume
+        if index == None and exists(self.backup_filename):
+            os.remove(self.backup_filename)
+
+        # Save publisher data, now with download results, to index file
+        self.save_index()
 
         self.msg("Finished downloading.  You made it!!!")
         return
 
+    def finish_download(self, i, result, details):
+        # Record a download, and hand the same file to every package that shares its URL
+        self.record_download(i, result, details)
+        for j in self.duplicates.get(i, []):
+            if result in ("GOOD", "UNCHANGED"):
+                link_blob(self.data_file(i), self.data_file(j))
+            self.record_download(j, result, details)
+        return
+
+    def prune_blobs(self):
+        # Remove stored files that no entry in the manifest points at any more
+        wanted = set(entry['SHA256'] + "." + name.split(".", 1)[1] for name, entry in self.manifest.items())
+        for name in os.listdir(self.blob_path):
+            if name not in wanted:
+                os.remove(self.blob_path + name)
+        return
+
+    def record_download(self, i, result, details):
+        # Copy one file's outcome into the index table and the manifest
+        self.tbl_publishers.at[i, 'Status'] = result
+        self.metrics.count("files " + result.lower())
+        for column in ['Error', 'Size', 'Transferred', 'SHA256', 'ETag', 'Last-Modified']:
+            if column in details:
+                self.tbl_publishers.at[i, column] = details[column]
+        if result == "GOOD":
+            print("+ Downloaded " + str(i+1) + " of " + str(len(self.file_url)) + " from " + self.file_url[i])
+            print("  - Saved as " + self.data_file(i))
+        elif result == "UNCHANGED":
+            print("+ Unchanged " + str(i+1) + " of " + str(len(self.file_url)) + " from " + self.file_url[i])
+        elif result == "OFFLINE":
+            print("+ Using local copy of " + str(i+1) + " of " + str(len(self.file_url)))
+            return
+        else:
+            print("+ Failed " + str(i+1) + " of " + str(len(self.file_url)) + " from " + self.file_url[i])
+            print("  - " + details['Error'])
+        if result in ("GOOD", "UNCHANGED"):
+            if self.schema.update(self.data_file(i), details['SHA256']):
+                self.metrics.count("files inspected")
+            self.manifest[os.path.basename(self.data_file(i))] = {
+                'URL': self.file_url[i],
+                'Modify Date': self.modify_date[i],
+                'ETag': details['ETag'],
+                'Last-Modified': details['Last-Modified'],
+                'Size': int(details['Size']),
+                'SHA256': details['SHA256']
+                }
+        return
+
+    def use_local_files(self, index=None):
+        # Mark every file already in data/ as available, with what the manifest knows about it
+        if index == None:
+            indexes = range(0,len(self.file_url))
+        else:
+            indexes = [index]
+        for i in indexes:
+            if self.file_url[i] == "NULL":
+                self.tbl_publishers.at[i, 'Status'] = "SKIPPED"
+            elif exists(self.data_file(i)):
+                self.record_download(i, "OFFLINE", self.manifest.get(os.path.basename(self.data_file(i)), {}))
+            else:
+                self.tbl_publishers.at[i, 'Status'] = "MISSING"
+        return
+
+    def load_backup(self):
+        # Reuse the statuses of an interrupted batch, as long as it was for the same catalog
+        if not exists(self.backup_filename):
+            print("+ Starting from scratch.")
+            return
+        backup = pandas.read_csv(self.backup_filename, index_col='Key', keep_default_na=False)
+        if backup['URL'].tolist() != self.file_url:
+            print("+ Backup file is for a different catalog.  Starting from scratch.")
+            return
+        print("+ Using backup file.")
+        for column in ['Status', 'Error', 'Size', 'Transferred', 'SHA256', 'ETag', 'Last-Modified']:
+            if column in backup:
+                self.tbl_publishers[column] = backup[column]
+        for i in range(0, len(self.file_url)):
+            if self.tbl_publishers['Status'][i] not in FINISHED:
+                print("  - Found. Starting on row", i)
+                break
+        return
+
+    def load_manifest(self):
+        # Manifest of every file we hold, keyed by its name under data/
+        self.manifest_filename = self.path + "Manifest.json"
+        self.manifest = {}
+        if exists(self.manifest_filename):
+            with open(self.manifest_filename) as file:
+                self.manifest = json.load(file)
+        return
+
+    def manifest_entry(self, i):
+        # Only trust the manifest if the file is still there and still comes from the same URL
+        entry = self.manifest.get(os.path.basename(self.data_file(i)))
+        if entry and entry['URL'] == self.file_url[i] and exists(self.data_file(i)):
+            return entry
+        return None
+
+    def save_manifest(self):
+        # Write to a temporary file first so a crash cannot corrupt the manifest
+        temp_filename = self.manifest_filename + ".part"
+        with open(temp_filename, 'w') as file:
+            json.dump(self.manifest, file, indent=2)
+        os.replace(temp_filename, self.manifest_filename)
+        return
+
     def search_headers(self, search_criteria, index=None):
         self.msg("Searching for headers with the words " + str(search_criteria))
 
@@ -199,69 +1155,70 @@ class GovDataCollector:
             self.orgs_list   = []
             self.headers_list = []
 
+            # catch the schema catalog up with whatever is on disk, then search it
             for i in range(0, len(self.organizations)):
-                filename = self.data_path + str(i) + self.format
+                filename = self.data_file(i)
                 if exists(filename):
-                    with open(filename) as file:
-                        headers = file.readline()
-                        for term in search_criteria:
-                            if term in headers.lower():
-                                self.files_list.append(str(i) + self.format)
-                                self.orgs_list.append(self.organizations[i])
-                                self.headers_list.append(headers)
-                                break
+                    if self.schema.update(filename):
+                        self.metrics.count("files inspected")
+                else:
+                    self.schema.forget(filename)
+            matches = self.schema.search(search_criteria)
+
+            for i in range(0, len(self.organizations)):
+                filename = os.path.basename(self.data_file(i))
+                if filename in matches:
+                    self.files_list.append(filename)
+                    self.orgs_list.append(self.organizations[i])
+                    self.headers_list.append(self.schema.header(filename))
             self.tbl_headers = pandas.DataFrame({
                 'Filename':self.files_list,
                 'Organization':self.orgs_list,
                 'Headers':self.headers_list,
                 })
-            self.tbl_headers.to_excel(self.index_writer, sheet_name = 'Matched_Headers', index=False)
-            self.index_writer.save()
+            self.tbl_headers.to_parquet(self.headers_filename, engine='pyarrow', index=False)
+            print("+ Matched headers saved at " + self.headers_filename)
             return self.tbl_headers
         else:
-            filename = self.data_path + str(index) + self.format
+            filename = self.data_file(index)
             if exists(filename):
-                with open(filename) as file:
-                    headers = file.readline().lower()
-                    return headers
+                self.schema.update(filename)
+                return self.schema.header(filename).lower()
 
-    def filter_headers(self, search_criteria, filter_criteria, index=None):
+    def filter_headers(self, search_criteria, filter_criteria, index=None, processes=None, chunk_size=100000):
         self.msg("Extracting columns with these words: \n" + str(filter_criteria))
-        def filter_headers_loop(i):
-            old_file = self.data_path + str(i) + self.format
-            new_file = self.data_path + str(i) + "_filtered" + self.format
-            try:
-                print("+ Searching '" + old_file + "'")
-                df = pandas.read_csv(old_file, low_memory=False)
-                has_names = False
-                tbl_filtered = pandas.DataFrame()
-                for column_name in df:
-                    for word in search_criteria:
-                        if word in column_name.lower():
-                            has_names = True
-                    for word in filter_criteria:
-                        if word in column_name.lower():
-                            tbl_filtered[column_name] = df[[column_name]].copy()
-                            break
-                if has_names == True:
-                    print("  - Found data in '" + old_file + "'")
-                    tbl_filtered.insert(0, "org_index", self.organizations[i])
-                    tbl_filtered.to_csv(new_file, index=False)
-                    print("  - Saving data at '" + new_file + "'")
-                else:
-                    print("  - No names found.")
-            except FileNotFoundError:
-                print("  - File '" + old_file + "' does not exist.")
         if index == None:
             # Generate smaller CSVs with just the data we need
-            for i in range(0,len(self.organizations)):
-                filter_headers_loop(i)
-            self.msg("New files saved in the folder " + self.data_path)
-            return
+            indexes = range(0,len(self.organizations))
         else:
-            filter_headers_loop(index)
-            self.msg("New files saved in the folder " + self.data_path)
-            return
+            indexes = [index]
+        # Packages that share a stored file are filtered in one pass over it
+        datasets = {}
+        for i in indexes:
+            old_file = self.data_file(i)
+            new_file = self.data_path + str(i) + "_filtered" + self.format
+            if exists(old_file):
+                stat = os.stat(old_file)
+                key = (stat.st_dev, stat.st_ino)
+                if key not in datasets:
+                    datasets[key] = (old_file, [])
+                datasets[key][1].append((new_file, self.organizations[i]))
+            else:
+                print("+ Searching '" + old_file + "'")
+                print("  - File '" + old_file + "' does not exist.")
+        # create a process pool executor, one worker per core unless told otherwise
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+            jobs = []
+            for old_file, targets in datasets.values():
+                jobs.append(executor.submit(column_filter, old_file, targets, search_criteria, filter_criteria, chunk_size))
+            # print each file's report as soon as it is done
+            for instance in concurrent.futures.as_completed(jobs):
+                messages, rows = instance.result()
+                print("\n".join(messages))
+                self.metrics.count("datasets filtered")
+                self.metrics.count("rows filtered", rows)
+        self.msg("New files saved in the folder " + self.data_path)
+        return
 
 ##########################
 #          MAIN          #
@@ -274,6 +1231,16 @@ def main(argv):
     format = "csv"
     search_criteria = {"name"}
     download = False
+    workers = 8
+    host_workers = 2
+    max_bytes = None
+    cache_ttl = 0
+    offline = False
+    excel = False
+    processes = None
+    compression = ""
+    profile = False
+    catalog_url = "https://catalog.data.gov/api/3"
     # customize as needed based on the columns you want to grab
     filter_criteria = {
         "name",
@@ -298,9 +1265,9 @@ def main(argv):
     ███████ █████ ███ ██ █████ █████ ▄▄▄██ ██████ ████ ███ ██ ▀▀▄████████
     ███████ ▀▀▄██ ▀▀▀ ██ ▀▀ ██ ▀▀ ██ ▀▀▀██ ▀▀▄███ ████ ▀▀▀ ██ ██ ████████
     ▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀▀
-    \n""" + "Usage:  " + sys.argv[0] + " -p <path> -f <file_format> -r <max_records>\nAdd -d to download and analyze files"
+    \n""" + "Usage:  " + sys.argv[0] + " -p <path> -f <file_format> -r <max_records>\nUse -r 0 to collect the whole catalog\nAdd -d to download and analyze files\nUse -w <workers> and -c <connections_per_host> to tune downloads\nUse -m <max_megabytes> to skip files larger than that\nUse -t <cache_hours> to reuse a catalog crawl younger than that (off by default)\nAdd --offline to run from cached catalog pages and files already downloaded\nUse -j <processes> to limit how many files are filtered at once\nUse -z <gzip|zstd> to store downloaded files compressed\nAdd -x to also export the index as Index.xlsx\nUse -u <catalog_api_url> to search another CKAN catalog\nAdd -P to save cProfile stats for each stage under <path>profiles/ (main thread only)"
     try:
-        opts, args = getopt.getopt(argv,"hdp:f:r:")
+        opts, args = getopt.getopt(argv,"hdxPp:f:r:w:c:m:t:j:z:u:",["offline"])
     except getopt.GetoptError:
         print(help)
         sys.exit(2)
@@ -310,6 +1277,10 @@ def main(argv):
             sys.exit()
         elif opt == '-d':
             download = True
+        elif opt == '-x':
+            excel = True
+        elif opt == '-P':
+            profile = True
         elif opt in ("-p"):
             path = arg
             if path[-1:] != "/":
@@ -318,23 +1289,67 @@ def main(argv):
             format = arg
         elif opt in ("-r"):
             max_records = int(arg)
+        elif opt in ("-w"):
+            workers = int(arg)
+            if workers < 1:
+                print("Workers (-w) must be at least 1")
+                sys.exit(2)
+        elif opt in ("-c"):
+            host_workers = int(arg)
+            if host_workers < 1:
+                print("Downloads per host (-c) must be at least 1")
+                sys.exit(2)
+        elif opt in ("-m"):
+            max_bytes = int(float(arg) * 1024 * 1024)
+        elif opt in ("-t"):
+            cache_ttl = float(arg) * 3600
+        elif opt in ("-j"):
+            processes = int(arg)
+        elif opt in ("-z"):
+            compression = arg
+            if compression not in ("gzip", "zstd") or (compression == "zstd" and zstandard is None):
+                print("Compression must be gzip or zstd (zstd needs the zstandard package)")
+                sys.exit(2)
+        elif opt in ("-u"):
+            catalog_url = arg.rstrip("/")
+        elif opt == '--offline':
+            offline = True
     print()
-    print("#" * os.get_terminal_size()[0])
+    print("#" * shutil.get_terminal_size()[0])
     print("Save directory is", path)
     print("Data will be stored at", path + "data/")
-    print("Files will be saved as", format)
-    print("Max records to download are", str(max_records))
-    print("#" * os.get_terminal_size()[0])
+    print("Files will be saved as", format + COMPRESSION_SUFFIX[compression])
+    if max_records > 0:
+        print("Max records to download are", str(max_records))
+    else:
+        print("Max records to download are unlimited")
+    if offline:
+        print("Running offline from cached catalog pages")
+    print("#" * shutil.get_terminal_size()[0])
     print()
 
-    # test for GovDataCollector
-    test = GovDataCollector(search_term, max_records, path)
-    test.save_response()
-    test.enumerate(format, download)
+    # test for GovDataCollector, timing each stage for the run report
+    profile_path = None
+    if profile == True:
+        profile_path = path + "profiles/"
+    metrics = GovDataMetrics(profile_path)
+    with metrics.phase("catalog"):
+        test = GovDataCollector(search_term, max_records, path, cache_ttl=cache_ttl, offline=offline, compression=compression, metrics=metrics, catalog_url=catalog_url)
+        test.save_response()
+    with metrics.phase("enumerate"):
+        test.enumerate(format)
     if download == True:
-        test.download() # this downloads ALL files
-        test.search_headers(search_criteria)
-        test.filter_headers(search_criteria, filter_criteria)
+        with metrics.phase("download"):
+            test.download(workers=workers, host_workers=host_workers, max_bytes=max_bytes) # this downloads ALL files
+        with metrics.phase("search_headers"):
+            test.search_headers(search_criteria)
+        with metrics.phase("filter_headers"):
+            test.filter_headers(search_criteria, filter_criteria, processes=processes)
+    if excel == True:
+        with metrics.phase("export_excel"):
+            test.export_excel()
+    metrics.report(path + "Report.json")
+    print("Run report saved at " + path + "Report.json")
 
 if __name__ == "__main__":
    main(sys.argv[1:])